@@ -0,0 +1,313 @@
+import struct
+from iputils import IPPROTO_TCP
+from tcputils import FLAGS_FIN, FLAGS_SYN, FLAGS_RST, FLAGS_ACK, calc_checksum
+
+# Compressão de cabeçalhos TCP/IP de Van Jacobson (RFC 1144), usada pelo CSLIP.
+#
+# O tipo do pacote é indicado nos 4 bits mais significativos do primeiro byte
+# do quadro: 0x4_ é um datagrama IP comum, 0x7_ é um datagrama TCP não
+# comprimido (cujo campo protocolo carrega o número do slot de conexão) e
+# 0x8_ a 0xf_ é um cabeçalho comprimido.
+
+TYPE_IP = 0x40
+TYPE_UNCOMPRESSED_TCP = 0x70
+TYPE_COMPRESSED_TCP = 0x80
+
+NUM_SLOTS = 16
+
+FLAGS_PSH = 1<<3
+FLAGS_URG = 1<<5
+
+# Bits do byte de mudanças de um cabeçalho comprimido
+NEW_C = 0x40
+NEW_I = 0x20
+TCP_PUSH_BIT = 0x10
+NEW_S = 0x08
+NEW_A = 0x04
+NEW_W = 0x02
+NEW_U = 0x01
+
+# Combinações que nunca ocorrem naturalmente, usadas para casos especiais
+SPECIAL_I = NEW_S | NEW_W | NEW_U      # tráfego interativo ecoado
+SPECIAL_D = NEW_S | NEW_A | NEW_W | NEW_U   # transferência unidirecional
+SPECIALS_MASK = NEW_S | NEW_A | NEW_W | NEW_U
+
+
+def _codificar(n):
+    # Valores de 1 a 255 ocupam um byte; 0 e valores maiores ocupam três
+    if 0 < n < 256:
+        return bytes((n,))
+    return struct.pack('!BH', 0, n)
+
+
+def _decodificar(dados, i):
+    if dados[i] == 0:
+        return (dados[i+1] << 8) | dados[i+2], i + 3
+    return dados[i], i + 1
+
+
+class Compressor:
+    def __init__(self, num_slots=NUM_SLOTS):
+        """
+        Estado de compressão de um sentido de um enlace. Guarda, para cada
+        slot, o último cabeçalho TCP/IP enviado naquela conexão.
+        """
+        self._slots = [None] * num_slots
+        # Slots em ordem de uso, do mais recente para o menos recente
+        self._lru = list(range(num_slots))
+        self._ultimo_enviado = None
+
+    def comprimir(self, datagrama):
+        """
+        Retorna o quadro a ser transmitido no lugar de datagrama.
+        """
+        if len(datagrama) < 40 or datagrama[9] != IPPROTO_TCP:
+            return datagrama
+        ihl = 4 * (datagrama[0] & 0xf)
+        # Fragmentos não podem ser comprimidos
+        if struct.unpack('!H', datagrama[6:8])[0] & 0x3fff:
+            return datagrama
+        tcp = datagrama[ihl:]
+        if len(tcp) < 20:
+            return datagrama
+        hlen = ihl + 4 * (tcp[12] >> 4)
+        flags = tcp[13]
+        if flags & (FLAGS_SYN | FLAGS_FIN | FLAGS_RST) or not flags & FLAGS_ACK:
+            return datagrama
+
+        # Procura o slot da conexão (endereços e portas)
+        chave = datagrama[12:20] + tcp[:4]
+        slot = None
+        for i in self._lru:
+            ant = self._slots[i]
+            if ant is None:
+                continue
+            ant_ihl = 4 * (ant[0] & 0xf)
+            if ant[12:20] + ant[ant_ihl:ant_ihl+4] == chave:
+                slot = i
+                break
+        if slot is None:
+            # Reaproveita o slot usado há mais tempo
+            slot = self._lru[-1]
+            return self._nao_comprimido(slot, datagrama, hlen)
+        self._lru.remove(slot)
+        self._lru.insert(0, slot)
+
+        ant = self._slots[slot]
+        ant_ihl = 4 * (ant[0] & 0xf)
+        ant_hlen = ant_ihl + 4 * (ant[ant_ihl+12] >> 4)
+        # Versão/IHL/TOS, fragmentação, TTL/protocolo, offset do TCP e opções
+        # precisam ser iguais aos do cabeçalho anterior
+        if datagrama[0:2] != ant[0:2] or datagrama[6:10] != ant[6:10] or \
+                hlen != ant_hlen or datagrama[20:ihl] != ant[20:ihl] or \
+                tcp[12] != ant[ihl+12] or \
+                datagrama[ihl+20:hlen] != ant[ihl+20:hlen]:
+            return self._nao_comprimido(slot, datagrama, hlen)
+
+        seq, ack = struct.unpack('!II', tcp[4:12])
+        janela, checksum, urg = struct.unpack('!HHH', tcp[14:20])
+        ant_seq, ant_ack = struct.unpack('!II', ant[ihl+4:ihl+12])
+        ant_janela, _, ant_urg = struct.unpack('!HHH', ant[ihl+14:ihl+20])
+
+        mudancas = 0
+        deltas = bytearray()
+        if flags & FLAGS_URG:
+            deltas += _codificar(urg)
+            mudancas |= NEW_U
+        elif urg != ant_urg:
+            return self._nao_comprimido(slot, datagrama, hlen)
+        delta = (janela - ant_janela) & 0xffff
+        if delta:
+            deltas += _codificar(delta)
+            mudancas |= NEW_W
+        delta_a = (ack - ant_ack) & 0xffffffff
+        if delta_a:
+            if delta_a > 0xffff:
+                return self._nao_comprimido(slot, datagrama, hlen)
+            deltas += _codificar(delta_a)
+            mudancas |= NEW_A
+        delta_s = (seq - ant_seq) & 0xffffffff
+        if delta_s:
+            if delta_s > 0xffff:
+                return self._nao_comprimido(slot, datagrama, hlen)
+            deltas += _codificar(delta_s)
+            mudancas |= NEW_S
+
+        ant_dados = struct.unpack('!H', ant[2:4])[0] - ant_hlen
+        if mudancas == 0:
+            # Nada mudou. Se este pacote tem dados e o anterior não tinha, é um
+            # pacote de dados logo após um ACK; caso contrário é provavelmente
+            # uma retransmissão, e vai sem compressão para ressincronizar a
+            # outra ponta caso ela tenha perdido a versão comprimida.
+            if datagrama[2:4] == ant[2:4] or ant_dados != 0:
+                return self._nao_comprimido(slot, datagrama, hlen)
+        elif mudancas in (SPECIAL_I, SPECIAL_D):
+            # As mudanças coincidem com uma codificação especial
+            return self._nao_comprimido(slot, datagrama, hlen)
+        elif mudancas == NEW_S | NEW_A:
+            if delta_s == delta_a and delta_s == ant_dados:
+                mudancas = SPECIAL_I
+                deltas = bytearray()
+        elif mudancas == NEW_S:
+            if delta_s == ant_dados:
+                mudancas = SPECIAL_D
+                deltas = bytearray()
+
+        delta = (struct.unpack('!H', datagrama[4:6])[0] -
+                 struct.unpack('!H', ant[4:6])[0]) & 0xffff
+        if delta != 1:
+            deltas += _codificar(delta)
+            mudancas |= NEW_I
+        if flags & FLAGS_PSH:
+            mudancas |= TCP_PUSH_BIT
+
+        self._slots[slot] = datagrama[:hlen]
+        if self._ultimo_enviado != slot:
+            self._ultimo_enviado = slot
+            cabecalho = bytes((TYPE_COMPRESSED_TCP | mudancas | NEW_C, slot))
+        else:
+            cabecalho = bytes((TYPE_COMPRESSED_TCP | mudancas,))
+        return cabecalho + struct.pack('!H', checksum) + bytes(deltas) + \
+            datagrama[hlen:]
+
+    def _nao_comprimido(self, slot, datagrama, hlen):
+        self._lru.remove(slot)
+        self._lru.insert(0, slot)
+        self._slots[slot] = datagrama[:hlen]
+        self._ultimo_enviado = slot
+        quadro = bytearray(datagrama)
+        quadro[0] = (quadro[0] & 0x0f) | TYPE_UNCOMPRESSED_TCP
+        quadro[9] = slot
+        return bytes(quadro)
+
+
+class Descompressor:
+    def __init__(self, num_slots=NUM_SLOTS):
+        """
+        Estado de descompressão de um sentido de um enlace.
+        """
+        self._slots = [None] * num_slots
+        self._ultimo_recebido = None
+        # Após um erro, descarta pacotes comprimidos até que chegue um que
+        # identifique explicitamente a conexão
+        self._descartar = False
+
+    def erro(self):
+        """
+        Informa que um quadro foi perdido ou corrompido no enlace.
+        """
+        self._descartar = True
+
+    def descomprimir(self, quadro):
+        """
+        Retorna o datagrama IP correspondente a quadro, ou None se o quadro
+        precisar ser descartado.
+        """
+        if len(quadro) == 0:
+            return None
+        tipo = quadro[0] & 0xf0
+        if tipo == TYPE_IP:
+            return quadro
+        if tipo & TYPE_COMPRESSED_TCP:
+            return self._comprimido(quadro)
+        if tipo == TYPE_UNCOMPRESSED_TCP:
+            return self._nao_comprimido(quadro)
+        self.erro()
+        return None
+
+    def _nao_comprimido(self, quadro):
+        slot = quadro[9] if len(quadro) >= 40 else len(self._slots)
+        if slot >= len(self._slots):
+            self.erro()
+            return None
+        datagrama = bytearray(quadro)
+        datagrama[0] = (datagrama[0] & 0x0f) | TYPE_IP
+        datagrama[9] = IPPROTO_TCP
+        ihl = 4 * (datagrama[0] & 0xf)
+        if ihl < 20 or ihl + 20 > len(datagrama):
+            self.erro()
+            return None
+        hlen = ihl + 4 * (datagrama[ihl+12] >> 4)
+        if hlen < ihl + 20 or hlen > len(datagrama):
+            self.erro()
+            return None
+        self._slots[slot] = bytes(datagrama[:hlen])
+        self._ultimo_recebido = slot
+        self._descartar = False
+        return bytes(datagrama)
+
+    def _comprimido(self, quadro):
+        try:
+            return self.__comprimido(quadro)
+        except IndexError:
+            # Quadro truncado
+            self.erro()
+            return None
+
+    def __comprimido(self, quadro):
+        mudancas = quadro[0]
+        i = 1
+        if mudancas & NEW_C:
+            slot = quadro[1]
+            i = 2
+            if slot >= len(self._slots) or self._slots[slot] is None:
+                self.erro()
+                return None
+            self._ultimo_recebido = slot
+            self._descartar = False
+        elif self._descartar or self._ultimo_recebido is None:
+            return None
+        slot = self._ultimo_recebido
+
+        hdr = bytearray(self._slots[slot])
+        ihl = 4 * (hdr[0] & 0xf)
+        hlen = len(hdr)
+        hdr[ihl+16:ihl+18] = quadro[i:i+2]
+        i += 2
+        if mudancas & TCP_PUSH_BIT:
+            hdr[ihl+13] |= FLAGS_PSH
+        else:
+            hdr[ihl+13] &= ~FLAGS_PSH & 0xff
+
+        seq, ack = struct.unpack('!II', hdr[ihl+4:ihl+12])
+        janela, urg = struct.unpack('!H2xH', hdr[ihl+14:ihl+20])
+        ant_dados = struct.unpack('!H', hdr[2:4])[0] - hlen
+        especial = mudancas & SPECIALS_MASK
+        if especial == SPECIAL_I:
+            ack += ant_dados
+            seq += ant_dados
+        elif especial == SPECIAL_D:
+            seq += ant_dados
+        else:
+            if mudancas & NEW_U:
+                hdr[ihl+13] |= FLAGS_URG
+                urg, i = _decodificar(quadro, i)
+            else:
+                hdr[ihl+13] &= ~FLAGS_URG & 0xff
+            if mudancas & NEW_W:
+                delta, i = _decodificar(quadro, i)
+                janela += delta
+            if mudancas & NEW_A:
+                delta, i = _decodificar(quadro, i)
+                ack += delta
+            if mudancas & NEW_S:
+                delta, i = _decodificar(quadro, i)
+                seq += delta
+        hdr[ihl+4:ihl+12] = struct.pack('!II', seq & 0xffffffff, ack & 0xffffffff)
+        hdr[ihl+14:ihl+16] = struct.pack('!H', janela & 0xffff)
+        hdr[ihl+18:ihl+20] = struct.pack('!H', urg)
+
+        ident, = struct.unpack('!H', hdr[4:6])
+        if mudancas & NEW_I:
+            delta, i = _decodificar(quadro, i)
+            ident += delta
+        else:
+            ident += 1
+        hdr[4:6] = struct.pack('!H', ident & 0xffff)
+
+        dados = quadro[i:]
+        hdr[2:4] = struct.pack('!H', hlen + len(dados))
+        hdr[10:12] = b'\x00\x00'
+        hdr[10:12] = struct.pack('!H', calc_checksum(bytes(hdr[:ihl])))
+        self._slots[slot] = bytes(hdr)
+        return bytes(hdr) + dados
@@ -0,0 +1,241 @@
+import asyncio
+import collections
+import math
+import time
+import metricas
+from iputils import IPPROTO_ICMP, IPPROTO_TCP
+from tcputils import FLAGS_FIN, FLAGS_SYN, FLAGS_RST
+
+
+class FilaSaida:
+    def __init__(self, enlace, nome=None, taxa=115200, quantum=1500, limite=64,
+                 codel=False, alvo=0.005, intervalo=0.1):
+        """
+        Fila de saída de um Enlace, com escalonamento justo entre fluxos.
+
+        Os datagramas são transmitidos no ritmo da linha serial (taxa em
+        bits/s, considerando 10 bits por byte no formato 8N1), de forma que a
+        fila se forme aqui, e não no buffer do driver. ACKs puros e ICMP vão
+        para uma fila prioritária; os demais datagramas são separados por
+        fluxo (endereços, protocolo e portas) e atendidos por Deficit Round
+        Robin com o quantum fornecido (em bytes).
+
+        A fila guarda no máximo limite datagramas. Quando ela está cheia, um
+        datagrama que chega toma o lugar do mais antigo do fluxo com mais
+        bytes enfileirados (como no fq_codel), de forma que um único fluxo
+        volumoso não impeça a entrada de ACKs e de tráfego interativo; só se
+        não houver nenhum fluxo na fila o datagrama que chega é descartado. Se
+        codel for verdadeiro, também descarta na
+        saída, seguindo o CoDel (RFC 8289), quando o tempo de espera dos
+        datagramas ficar acima de alvo por mais de intervalo segundos. Em
+        enlaces lentos, alvo deve ser pelo menos o tempo de transmissão de um
+        datagrama de tamanho máximo.
+        """
+        self.enlace = enlace
+        self._segundos_por_byte = 10 / taxa
+        self._quantum = quantum
+        self._limite = limite
+        self._codel = codel
+        self._alvo = alvo
+        self._intervalo = intervalo
+
+        # Cada item é (instante de chegada, datagrama)
+        self._prioritaria = collections.deque()
+        self._fluxos = {}                    # chave do fluxo -> deque de itens
+        self._deficit = {}                   # chave do fluxo -> deficit em bytes
+        self._bytes_fluxo = {}               # chave do fluxo -> bytes enfileirados
+        self._ativos = collections.deque()   # fluxos com datagramas, em rodízio
+        self._tamanho = 0
+        self._bytes_fluxos = 0
+        self._transmitindo = False
+
+        # Estado do CoDel
+        self._primeiro_acima = 0
+        self._descartando = False
+        self._proximo_descarte = 0
+        self._contagem = 0
+        self._ultima_contagem = 0
+
+        prefixo = 'fila.%s.' % (nome if nome is not None else id(self))
+        reg = metricas.registro
+        self._m_enfileirados = reg.contador(prefixo + 'enfileirados')
+        self._m_transmitidos = reg.contador(prefixo + 'transmitidos')
+        self._m_descartes_cauda = reg.contador(prefixo + 'descartes_cauda')
+        self._m_descartes_fluxo = reg.contador(prefixo + 'descartes_fluxo')
+        self._m_descartes_codel = reg.contador(prefixo + 'descartes_codel')
+        self._m_comprimento = reg.medidor(prefixo + 'comprimento')
+        self._m_atraso = reg.histograma(prefixo + 'atraso')
+
+    def enfileirar(self, datagrama):
+        if self._tamanho >= self._limite and not self._descartar_maior_fluxo():
+            self._m_descartes_cauda.incrementar()
+            return
+        item = (time.monotonic(), datagrama)
+        chave = self._classificar(datagrama)
+        if chave is None:
+            self._prioritaria.append(item)
+        else:
+            fila = self._fluxos.get(chave)
+            if fila is None:
+                fila = self._fluxos[chave] = collections.deque()
+                self._deficit[chave] = 0
+                self._bytes_fluxo[chave] = 0
+                self._ativos.append(chave)
+            fila.append(item)
+            self._bytes_fluxo[chave] += len(datagrama)
+            self._bytes_fluxos += len(datagrama)
+        self._tamanho += 1
+        self._m_enfileirados.incrementar()
+        self._m_comprimento.definir(self._tamanho)
+        if not self._transmitindo:
+            self._transmitir()
+
+    def _descartar_maior_fluxo(self):
+        """
+        Descarta o datagrama mais antigo do fluxo com mais bytes enfileirados.
+        Retorna False se não houver nenhum fluxo na fila.
+        """
+        if not self._bytes_fluxo:
+            return False
+        chave = max(self._bytes_fluxo, key=self._bytes_fluxo.get)
+        fila = self._fluxos[chave]
+        _, datagrama = fila.popleft()
+        if fila:
+            self._bytes_fluxo[chave] -= len(datagrama)
+        else:
+            self._remover_fluxo(chave)
+            self._ativos.remove(chave)
+        self._bytes_fluxos -= len(datagrama)
+        self._tamanho -= 1
+        self._m_descartes_fluxo.incrementar()
+        return True
+
+    def _remover_fluxo(self, chave):
+        del self._fluxos[chave]
+        del self._deficit[chave]
+        del self._bytes_fluxo[chave]
+
+    def _classificar(self, datagrama):
+        """
+        Retorna None para datagramas da fila prioritária, ou a chave do fluxo
+        ao qual o datagrama pertence.
+        """
+        proto = datagrama[9]
+        if proto == IPPROTO_ICMP:
+            return None
+        if (datagrama[6] << 8 | datagrama[7]) & 0x3fff:
+            # Fragmento (MF ligado ou offset não nulo): só o primeiro traz o
+            # cabeçalho TCP, então todos os fragmentos de um datagrama ficam no
+            # fluxo definido apenas pelos endereços e protocolo
+            return datagrama[9:10] + datagrama[12:20]
+        ihl = 4 * (datagrama[0] & 0xf)
+        if proto == IPPROTO_TCP and len(datagrama) >= ihl + 20:
+            tcp_hlen = 4 * (datagrama[ihl+12] >> 4)
+            flags = datagrama[ihl+13]
+            if len(datagrama) == ihl + tcp_hlen and \
+                    not flags & (FLAGS_SYN | FLAGS_FIN | FLAGS_RST):
+                return None
+            return datagrama[9:10] + datagrama[12:20] + datagrama[ihl:ihl+4]
+        return datagrama[9:10] + datagrama[12:20]
+
+    def _transmitir(self):
+        item = self._proximo(time.monotonic())
+        if item is None:
+            self._transmitindo = False
+            return
+        self._transmitindo = True
+        chegada, datagrama = item
+        self._m_atraso.observar(time.monotonic() - chegada)
+        self._m_transmitidos.incrementar()
+        tamanho = self.enlace.enviar(datagrama)
+        if tamanho is None:
+            # Enlace que não informa o tamanho do quadro: estima com os dois
+            # delimitadores
+            tamanho = len(datagrama) + 2
+        # Aguarda o tempo de colocar o quadro (já comprimido e com escapes) na
+        # linha
+        asyncio.get_event_loop().call_later(
+            tamanho * self._segundos_por_byte, self._transmitir)
+
+    def _proximo(self, agora):
+        if self._prioritaria:
+            item = self._prioritaria.popleft()
+        elif self._codel:
+            item = self._retirar_codel(agora)
+        else:
+            item = self._retirar_fluxo()
+        if item is not None:
+            self._tamanho -= 1
+            self._m_comprimento.definir(self._tamanho)
+        return item
+
+    def _retirar_fluxo(self):
+        # Deficit Round Robin: cada fluxo ganha um quantum por rodada e só
+        # transmite enquanto o deficit acumulado cobrir o datagrama seguinte
+        while self._ativos:
+            chave = self._ativos[0]
+            fila = self._fluxos[chave]
+            tamanho = len(fila[0][1])
+            if self._deficit[chave] < tamanho:
+                self._deficit[chave] += self._quantum
+                self._ativos.rotate(-1)
+                continue
+            self._deficit[chave] -= tamanho
+            item = fila.popleft()
+            if fila:
+                self._bytes_fluxo[chave] -= tamanho
+            else:
+                self._remover_fluxo(chave)
+                self._ativos.popleft()
+            self._bytes_fluxos -= tamanho
+            return item
+        return None
+
+    def _retirar_codel(self, agora):
+        # Pseudocódigo de dequeue da RFC 8289, seção 5
+        item = self._retirar_fluxo()
+        pode_descartar = self._pode_descartar(item, agora)
+        if self._descartando:
+            if not pode_descartar:
+                self._descartando = False
+            while self._descartando and agora >= self._proximo_descarte:
+                self._descartar(item)
+                self._contagem += 1
+                item = self._retirar_fluxo()
+                if not self._pode_descartar(item, agora):
+                    self._descartando = False
+                else:
+                    self._proximo_descarte = self._lei_de_controle(self._proximo_descarte)
+        elif pode_descartar:
+            self._descartar(item)
+            item = self._retirar_fluxo()
+            self._pode_descartar(item, agora)
+            self._descartando = True
+            delta = self._contagem - self._ultima_contagem
+            if delta > 1 and agora - self._proximo_descarte < 16 * self._intervalo:
+                self._contagem = delta
+            else:
+                self._contagem = 1
+            self._proximo_descarte = self._lei_de_controle(agora)
+            self._ultima_contagem = self._contagem
+        return item
+
+    def _pode_descartar(self, item, agora):
+        if item is None:
+            self._primeiro_acima = 0
+            return False
+        # Não descarta se resta menos de um quantum na fila
+        if agora - item[0] < self._alvo or self._bytes_fluxos <= self._quantum:
+            self._primeiro_acima = 0
+            return False
+        if self._primeiro_acima == 0:
+            self._primeiro_acima = agora + self._intervalo
+            return False
+        return agora >= self._primeiro_acima
+
+    def _lei_de_controle(self, t):
+        return t + self._intervalo / math.sqrt(self._contagem)
+
+    def _descartar(self, item):
+        self._tamanho -= 1
+        self._m_descartes_codel.incrementar()
@@ -0,0 +1,163 @@
+import collections
+import struct
+import time
+import metricas
+from iputils import IPPROTO_ICMP
+from tcputils import str2addr, addr2str
+
+ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACH = 3
+ICMP_ECHO_REQUEST = 8
+ICMP_TIME_EXCEEDED = 11
+
+# Códigos de Destination Unreachable
+ICMP_NET_UNREACH = 0
+ICMP_FRAG_NEEDED = 4
+
+# Tipos de mensagem que não são de erro: só sobre eles podemos gerar erros
+# (RFC 1122, seção 3.2.2)
+_TIPOS_CONSULTA = (ICMP_ECHO_REPLY, ICMP_ECHO_REQUEST)
+
+
+def _soma(dados):
+    """
+    Soma complemento-de-um (sem a negação final) das palavras de 16 bits.
+    """
+    if len(dados) % 2 == 1:
+        dados = bytes(dados) + b'\x00'
+    soma = sum(struct.unpack('!%dH' % (len(dados) // 2), dados))
+    while soma > 0xffff:
+        soma = (soma & 0xffff) + (soma >> 16)
+    return soma
+
+
+def _checksum(soma):
+    while soma > 0xffff:
+        soma = (soma & 0xffff) + (soma >> 16)
+    return ~soma & 0xffff
+
+
+class ICMP:
+    def __init__(self, rede, taxa=10.0, rajada=20, max_origens=1024):
+        """
+        Subsistema ICMP da camada de rede rede (um objeto IP). As mensagens
+        geradas para cada destino são limitadas por um balde de fichas com
+        taxa mensagens/s e capacidade rajada; guardamos o balde de no máximo
+        max_origens destinos, esquecendo os usados há mais tempo.
+        """
+        self.rede = rede
+        self._taxa = taxa
+        self._rajada = rajada
+        self._max_origens = max_origens
+        self._baldes = collections.OrderedDict()   # destino -> [fichas, instante]
+
+        # Modelo do cabeçalho IP das mensagens geradas, refeito quando o
+        # endereço do host muda
+        self._modelo_src = None
+        self._modelo = None
+        self._soma_modelo = 0
+
+        reg = metricas.registro
+        self._m_enviadas = reg.contador('icmp.mensagens_enviadas')
+        self._m_limitadas = reg.contador('icmp.mensagens_limitadas')
+        self._m_echo = reg.contador('icmp.echo_respondidos')
+        self._m_invalidas = reg.contador('icmp.mensagens_invalidas')
+
+    def _permitir(self, destino):
+        agora = time.monotonic()
+        balde = self._baldes.get(destino)
+        if balde is None:
+            balde = self._baldes[destino] = [self._rajada, agora]
+            if len(self._baldes) > self._max_origens:
+                self._baldes.popitem(last=False)
+        else:
+            self._baldes.move_to_end(destino)
+            balde[0] = min(self._rajada, balde[0] + (agora - balde[1]) * self._taxa)
+            balde[1] = agora
+        if balde[0] < 1:
+            self._m_limitadas.incrementar()
+            return False
+        balde[0] -= 1
+        return True
+
+    def _cabecalho_ip(self, dest_addr, tamanho_icmp):
+        src = self.rede.meu_endereco if self.rede.meu_endereco is not None else '0.0.0.0'
+        if src != self._modelo_src:
+            # versão/IHL, TTL = 64, protocolo e endereço de origem não mudam
+            self._modelo = bytearray(struct.pack('!BBHHHBBH4s4s', (4 << 4) | 5, 0, 0,
+                                                 0, 0, 64, IPPROTO_ICMP, 0,
+                                                 str2addr(src), b'\x00' * 4))
+            self._soma_modelo = _soma(self._modelo)
+            self._modelo_src = src
+        hdr = self._modelo
+        total_len = 20 + tamanho_icmp
+        identificacao = self.rede.proxima_identificacao()
+        dst_b = str2addr(dest_addr)
+        hdr[2:4] = struct.pack('!H', total_len)
+        hdr[4:6] = struct.pack('!H', identificacao)
+        hdr[16:20] = dst_b
+        # Soma só os campos variáveis à soma já calculada do modelo
+        soma = self._soma_modelo + total_len + identificacao + _soma(dst_b)
+        hdr[10:12] = struct.pack('!H', _checksum(soma))
+        cabecalho = bytes(hdr)
+        hdr[10:12] = b'\x00\x00'
+        return cabecalho
+
+    def _enviar(self, dest_addr, mensagem):
+        next_hop = self.rede.proximo_salto(dest_addr)
+        if next_hop is None:
+            return
+        datagrama = self._cabecalho_ip(dest_addr, len(mensagem)) + mensagem
+        self.rede.enviar_datagrama(datagrama, next_hop)
+        self._m_enviadas.incrementar()
+
+    def enviar_erro(self, tipo, codigo, resto, datagrama_original):
+        """
+        Envia ao remetente de datagrama_original uma mensagem ICMP de erro
+        com o tipo e código fornecidos. O argumento resto contém os 4 bytes
+        seguintes ao checksum, e a mensagem carrega os primeiros 28 bytes do
+        datagrama original.
+        """
+        # Não gera erros sobre fragmentos que não sejam o primeiro, nem sobre
+        # outras mensagens ICMP de erro
+        ihl = 4 * (datagrama_original[0] & 0xf)
+        if struct.unpack('!H', datagrama_original[6:8])[0] & 0x1fff:
+            return
+        if datagrama_original[9] == IPPROTO_ICMP and \
+                (len(datagrama_original) <= ihl or
+                 datagrama_original[ihl] not in _TIPOS_CONSULTA):
+            return
+        dest_addr = addr2str(datagrama_original[12:16])
+        if not self._permitir(dest_addr):
+            return
+        corpo = resto + bytes(datagrama_original[:28])
+        soma = ((tipo << 8) | codigo) + _soma(corpo)
+        mensagem = struct.pack('!BBH', tipo, codigo, _checksum(soma)) + corpo
+        self._enviar(dest_addr, mensagem)
+
+    def receber(self, src_addr, mensagem):
+        """
+        Trata uma mensagem ICMP destinada a este host.
+        """
+        if len(mensagem) < 8 or _soma(mensagem) != 0xffff:
+            self._m_invalidas.incrementar()
+            return
+        tipo, codigo = mensagem[0], mensagem[1]
+        if tipo == ICMP_ECHO_REQUEST:
+            if not self._permitir(src_addr):
+                return
+            # A resposta só difere no tipo (8 -> 0), então o checksum pode ser
+            # ajustado de forma incremental (RFC 1624): HC' = ~(~HC + ~m + m')
+            checksum, = struct.unpack('!H', mensagem[2:4])
+            m = (ICMP_ECHO_REQUEST << 8) | codigo
+            m_novo = (ICMP_ECHO_REPLY << 8) | codigo
+            checksum = _checksum((~checksum & 0xffff) + (~m & 0xffff) + m_novo)
+            resposta = struct.pack('!BBH', ICMP_ECHO_REPLY, codigo, checksum) + mensagem[4:]
+            self._enviar(src_addr, resposta)
+            self._m_echo.incrementar()
+        elif tipo == ICMP_DEST_UNREACH and codigo == ICMP_FRAG_NEEDED and len(mensagem) >= 28:
+            # Fragmentation Needed: informa o MTU do caminho até o destino do
+            # datagrama original, cujo cabeçalho vem a partir do byte 8
+            mtu, = struct.unpack('!H', mensagem[6:8])
+            self.rede.atualizar_pmtu(addr2str(mensagem[20:24]),
+                                     addr2str(mensagem[24:28]), mtu)
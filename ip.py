@@ -1,5 +1,23 @@
 from iputils import *
+import collections
+import random
 import struct
+import time
+import metricas
+from icmp import ICMP, ICMP_DEST_UNREACH, ICMP_TIME_EXCEEDED, ICMP_NET_UNREACH, \
+    ICMP_FRAG_NEEDED
+
+# Bits do campo flags do cabeçalho IPv4
+IP_DF = 0b010   # Don't Fragment
+IP_MF = 0b001   # More Fragments
+
+MTU_PADRAO = 1500
+MTU_MINIMO = 68                 # RFC 791
+VALIDADE_PMTU = 600.0           # segundos até esquecer um MTU de caminho (RFC 1191)
+
+# Limites do cache de remontagem de fragmentos
+TEMPO_REMONTAGEM = 30.0          # segundos (RFC 791 sugere 15s; Linux usa 30s)
+LIMITE_REMONTAGEM = 256 * 1024   # bytes de fragmentos guardados ao mesmo tempo
 
 class IP:
     def __init__(self, enlace):
@@ -14,50 +32,59 @@ class IP:
         self.ignore_checksum = self.enlace.ignore_checksum
         self.meu_endereco = None
         self._tabela = []
+        self._mtus = {}           # next_hop -> MTU do enlace
+        self._pmtu = {}           # destino -> (MTU do caminho, instante), via ICMP
+        self._identificacao = random.randint(0, 0xffff)
+        # (src, dst, id, proto) -> [instante de criação, {offset: dados}, tamanho total]
+        self._remontagem = collections.OrderedDict()
+        self._bytes_remontagem = 0
+        self.icmp = ICMP(self)
+
+        reg = metricas.registro
+        self._m_recebidos = reg.contador('ip.datagramas_recebidos')
+        self._m_entregues = reg.contador('ip.datagramas_entregues')
+        self._m_encaminhados = reg.contador('ip.datagramas_encaminhados')
+        self._m_ttl_expirado = reg.contador('ip.ttl_expirado')
+        self._m_destino_inalcancavel = reg.contador('ip.destino_inalcancavel')
+        self._m_enviados = reg.contador('ip.datagramas_enviados')
+        self._m_consultas_rota = reg.contador('ip.consultas_rota')
+        self._m_sem_rota = reg.contador('ip.sem_rota')
+        self._m_fragmentos_enviados = reg.contador('ip.fragmentos_enviados')
+        self._m_fragmentos_recebidos = reg.contador('ip.fragmentos_recebidos')
+        self._m_remontados = reg.contador('ip.datagramas_remontados')
+        self._m_remontagens_descartadas = reg.contador('ip.remontagens_descartadas')
+        self._m_fragmentacao_necessaria = reg.contador('ip.fragmentacao_necessaria')
 
     def __raw_recv(self, datagrama):
         dscp, ecn, identification, flags, frag_offset, ttl, proto, \
            src_addr, dst_addr, payload = read_ipv4_header(datagrama, verify_checksum=not self.ignore_checksum)
+        self._m_recebidos.incrementar()
         if dst_addr == self.meu_endereco:
             # atua como host
+            if flags & IP_MF or frag_offset:
+                self._m_fragmentos_recebidos.incrementar()
+                payload = self._remontar(src_addr, dst_addr, identification,
+                                         proto, flags, frag_offset, payload)
+                if payload is None:
+                    return
+            self._m_entregues.incrementar()
             if proto == IPPROTO_TCP and self.callback:
                 self.callback(src_addr, dst_addr, payload)
+            elif proto == IPPROTO_ICMP:
+                self.icmp.receber(src_addr, payload)
         else:
             # atua como roteador
             next_hop = self._next_hop(dst_addr)
             # Trata corretamente o campo TTL do datagrama
             if ttl <= 1:
-                # TTL expirou: envie ICMP Time Exceeded para o remetente (src_addr)
-                # Construir mensagem ICMP: tipo 11, código 0, 4 bytes zero, seguido dos primeiros 28 bytes do datagrama original
-                icmp_hdr = struct.pack('!BBH4s', 11, 0, 0, b'\x00\x00\x00\x00')
-                icmp_payload = icmp_hdr + datagrama[:28]
-                # calcule checksum do ICMP (colocando-o nos bytes 2:4)
-                icmp_msg = bytearray(icmp_payload)
-                ck = calc_checksum(bytes(icmp_msg))
-                icmp_msg[2:4] = struct.pack('!H', ck)
-                icmp_msg = bytes(icmp_msg)
-
-                # Montar cabeçalho IP para o pacote ICMP
-                src = self.meu_endereco if self.meu_endereco is not None else '0.0.0.0'
-                version_ihl = (4 << 4) | 5
-                dscpecn = 0
-                total_len = 20 + len(icmp_msg)
-                identification = 0
-                flagsfrag = 0
-                ttl_new = 64
-                proto_icmp = IPPROTO_ICMP
-                checksum = 0
-                src_b = str2addr(src)
-                dst_b = str2addr(src_addr)  # destino do ICMP é o remetente original
-                ip_hdr = struct.pack('!BBHHHBBH4s4s', version_ihl, dscpecn, total_len,
-                                     identification, flagsfrag, ttl_new, proto_icmp,
-                                     checksum, src_b, dst_b)
-                ch = calc_checksum(ip_hdr)
-                ip_hdr = struct.pack('!BBHHHBBH4s4s', version_ihl, dscpecn, total_len,
-                                     identification, flagsfrag, ttl_new, proto_icmp,
-                                     ch, src_b, dst_b)
-                icmp_datagram = ip_hdr + icmp_msg
-                self.enlace.enviar(icmp_datagram, next_hop)
+                # TTL expirou: envie ICMP Time Exceeded (tipo 11, código 0) para o remetente
+                self._m_ttl_expirado.incrementar()
+                self.icmp.enviar_erro(ICMP_TIME_EXCEEDED, 0, b'\x00\x00\x00\x00', datagrama)
+            elif next_hop is None:
+                # Não há rota: envie ICMP Destination Unreachable para o remetente
+                self._m_destino_inalcancavel.incrementar()
+                self.icmp.enviar_erro(ICMP_DEST_UNREACH, ICMP_NET_UNREACH,
+                                      b'\x00\x00\x00\x00', datagrama)
             else:
                 # decrementa TTL, atualiza checksum do cabeçalho e encaminha
                 new_dat = bytearray(datagrama)
@@ -67,7 +94,160 @@ class IP:
                 hdr = bytes(new_dat[:20])
                 chk = calc_checksum(hdr)
                 new_dat[10:12] = struct.pack('!H', chk)
-                self.enlace.enviar(bytes(new_dat), next_hop)
+                if self.enviar_datagrama(bytes(new_dat), next_hop):
+                    self._m_encaminhados.incrementar()
+                else:
+                    # DF ligado e o datagrama não cabe no próximo enlace: envie
+                    # ICMP Fragmentation Needed (tipo 3, código 4) com o MTU
+                    self._m_fragmentacao_necessaria.incrementar()
+                    resto = struct.pack('!HH', 0, self._mtu(next_hop))
+                    self.icmp.enviar_erro(ICMP_DEST_UNREACH, ICMP_FRAG_NEEDED, resto, datagrama)
+
+    def enviar_datagrama(self, datagrama, next_hop):
+        """
+        Envia um datagrama já montado para next_hop, fragmentando-o se ele não
+        couber no MTU do enlace. Retorna False se o datagrama precisaria ser
+        fragmentado mas está com o bit DF ligado.
+        """
+        mtu = self._mtu(next_hop)
+        if len(datagrama) <= mtu:
+            self.enlace.enviar(datagrama, next_hop)
+            return True
+
+        flagsfrag, = struct.unpack('!H', datagrama[6:8])
+        flags = flagsfrag >> 13
+        if flags & IP_DF:
+            return False
+        frag_offset = flagsfrag & 0x1fff
+        ihl = 4 * (datagrama[0] & 0xf)
+        hdr = datagrama[:ihl]
+        payload = datagrama[ihl:]
+        # Todo fragmento, exceto o último, deve carregar um múltiplo de 8 bytes
+        passo = (mtu - ihl) // 8 * 8
+        for i in range(0, len(payload), passo):
+            pedaco = payload[i:i+passo]
+            mf = IP_MF if i + passo < len(payload) else flags & IP_MF
+            frag = bytearray(hdr)
+            frag[2:4] = struct.pack('!H', ihl + len(pedaco))
+            frag[6:8] = struct.pack('!H', (mf << 13) | (frag_offset + i // 8))
+            frag[10:12] = b'\x00\x00'
+            frag[10:12] = struct.pack('!H', calc_checksum(bytes(frag)))
+            self.enlace.enviar(bytes(frag) + pedaco, next_hop)
+            self._m_fragmentos_enviados.incrementar()
+        return True
+
+    def _remontar(self, src_addr, dst_addr, identification, proto, flags, frag_offset, payload):
+        """
+        Guarda um fragmento no cache de remontagem. Retorna a carga útil do
+        datagrama original quando todos os fragmentos tiverem chegado, ou None
+        enquanto ainda faltarem fragmentos.
+        """
+        agora = time.monotonic()
+        # Descarta as remontagens mais antigas que expiraram
+        while self._remontagem:
+            chave, entrada = next(iter(self._remontagem.items()))
+            if agora - entrada[0] < TEMPO_REMONTAGEM:
+                break
+            self._descartar_remontagem(chave)
+
+        inicio = 8 * frag_offset
+        if inicio + len(payload) > 0xffff:
+            return None
+        chave = (src_addr, dst_addr, identification, proto)
+        entrada = self._remontagem.get(chave)
+        if entrada is None:
+            entrada = [agora, {}, None]
+            self._remontagem[chave] = entrada
+        fragmentos = entrada[1]
+        if inicio not in fragmentos:
+            fragmentos[inicio] = payload
+            self._bytes_remontagem += len(payload)
+        if not flags & IP_MF:
+            entrada[2] = inicio + len(payload)
+
+        # Respeita o limite de memória descartando as remontagens mais antigas
+        while self._bytes_remontagem > LIMITE_REMONTAGEM:
+            self._descartar_remontagem(next(iter(self._remontagem)))
+        if chave not in self._remontagem or entrada[2] is None:
+            return None
+
+        # Verifica se não há buracos entre os fragmentos recebidos
+        pos = 0
+        for inicio in sorted(fragmentos):
+            if inicio > pos:
+                return None
+            pos = max(pos, inicio + len(fragmentos[inicio]))
+        if pos < entrada[2]:
+            return None
+
+        buf = bytearray(entrada[2])
+        for inicio in sorted(fragmentos):
+            buf[inicio:inicio+len(fragmentos[inicio])] = fragmentos[inicio]
+        self._bytes_remontagem -= sum(len(f) for f in fragmentos.values())
+        del self._remontagem[chave]
+        self._m_remontados.incrementar()
+        return bytes(buf[:entrada[2]])
+
+    def _descartar_remontagem(self, chave):
+        entrada = self._remontagem.pop(chave)
+        self._bytes_remontagem -= sum(len(f) for f in entrada[1].values())
+        self._m_remontagens_descartadas.incrementar()
+
+    def proxima_identificacao(self):
+        """
+        Retorna o campo Identification do próximo datagrama gerado por este host.
+        """
+        self._identificacao = (self._identificacao + 1) & 0xffff
+        return self._identificacao
+
+    def _mtu(self, next_hop):
+        return self._mtus.get(next_hop, MTU_PADRAO)
+
+    def definir_mtu(self, next_hop, mtu):
+        """
+        Define o MTU do enlace que alcança next_hop (string no formato
+        x.y.z.w). Os enlaces não configurados usam MTU_PADRAO.
+        """
+        if mtu < MTU_MINIMO:
+            raise ValueError('MTU deve ser pelo menos %d' % MTU_MINIMO)
+        self._mtus[next_hop] = mtu
+
+    def atualizar_pmtu(self, origem, destino, mtu):
+        """
+        Registra o MTU do caminho até destino informado por um ICMP
+        Fragmentation Needed sobre um datagrama enviado de origem. Mensagens
+        sobre datagramas que não partiram deste host, ou com MTU inválido,
+        são ignoradas.
+        """
+        if origem != self.meu_endereco or mtu < MTU_MINIMO:
+            return
+        atual = self._mtu_caminho(destino, self._next_hop(destino))
+        self._pmtu[destino] = (min(mtu, atual), time.monotonic())
+
+    def _mtu_caminho(self, dest_addr, next_hop):
+        mtu = self._mtu(next_hop)
+        pmtu = self._pmtu.get(dest_addr)
+        if pmtu is None:
+            return mtu
+        if time.monotonic() - pmtu[1] > VALIDADE_PMTU:
+            # Expirou: volta a tentar o MTU do enlace
+            del self._pmtu[dest_addr]
+            return mtu
+        return min(mtu, pmtu[0])
+
+    def mss_para(self, dest_addr):
+        """
+        Retorna o maior payload TCP que pode ser enviado até dest_addr sem
+        fragmentação, considerando o MTU do enlace e o MTU do caminho
+        descoberto via ICMP Fragmentation Needed.
+        """
+        return self._mtu_caminho(dest_addr, self._next_hop(dest_addr)) - 40
+
+    def proximo_salto(self, dest_addr):
+        """
+        Retorna o next_hop da rota para dest_addr, ou None se não houver rota.
+        """
+        return self._next_hop(dest_addr)
 
     def _next_hop(self, dest_addr):
         # Converte IP para inteiro
@@ -83,6 +263,9 @@ class IP:
                 if prefixlen > best_prefix:
                     best_prefix = prefixlen
                     best = next_hop
+        self._m_consultas_rota.incrementar()
+        if best is None:
+            self._m_sem_rota.incrementar()
         return best
 
     def definir_endereco_host(self, meu_endereco):
@@ -132,12 +315,19 @@ class IP:
         (string no formato x.y.z.w).
         """
         next_hop = self._next_hop(dest_addr)
+        if next_hop is None:
+            # Sem rota para o destino: descarta
+            return
         src = self.meu_endereco if self.meu_endereco is not None else '0.0.0.0'
         version_ihl = (4 << 4) | 5
         dscpecn = 0
         total_len = 20 + len(segmento)
-        identification = 0
-        flagsfrag = 0
+        identification = self.proxima_identificacao()
+        # Liga o DF para descobrir o MTU do caminho. Se o datagrama já não
+        # cabe no MTU conhecido (por exemplo, numa retransmissão feita antes
+        # de o MTU diminuir), deixa que ele seja fragmentado.
+        mtu = self._mtu_caminho(dest_addr, next_hop)
+        flagsfrag = (IP_DF << 13) if total_len <= mtu else 0
         ttl = 64
         proto = IPPROTO_TCP
         checksum = 0
@@ -151,7 +341,8 @@ class IP:
                              identification, flagsfrag, ttl, proto,
                              ch, src_b, dst_b)
         datagrama = ip_hdr + segmento
-        self.enlace.enviar(datagrama, next_hop)
+        self.enviar_datagrama(datagrama, next_hop)
+        self._m_enviados.incrementar()
 
 # Implementa a camada de rede IPv4, capaz de agir como Host ou Roteador. 
 # Como Host, ele recebe pacotes destinados a si mesmo e os entrega à camada superior.
@@ -0,0 +1,172 @@
+import asyncio
+import bisect
+import json
+
+
+# Limites (em segundos) usados por padrão nos histogramas de tempo
+LIMITES_TEMPO = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Contador:
+    """
+    Contador monotônico. Só é atualizado enquanto o registro estiver ativo.
+    """
+    __slots__ = ('_registro', 'valor')
+
+    def __init__(self, registro):
+        self._registro = registro
+        self.valor = 0
+
+    def incrementar(self, n=1):
+        if self._registro.ativo:
+            self.valor += n
+
+    def exportar(self):
+        return self.valor
+
+
+class Medidor:
+    """
+    Valor instantâneo (por exemplo, bytes em trânsito numa conexão).
+    """
+    __slots__ = ('_registro', 'valor')
+
+    def __init__(self, registro):
+        self._registro = registro
+        self.valor = 0
+
+    def definir(self, valor):
+        if self._registro.ativo:
+            self.valor = valor
+
+    def exportar(self):
+        return self.valor
+
+
+class Histograma:
+    """
+    Histograma de baldes fixos. O balde i conta as observações menores ou
+    iguais a limites[i]; o último balde conta as que excedem todos os limites.
+    """
+    __slots__ = ('_registro', 'limites', 'baldes', 'soma', 'n')
+
+    def __init__(self, registro, limites=LIMITES_TEMPO):
+        self._registro = registro
+        self.limites = tuple(limites)
+        self.baldes = [0] * (len(self.limites) + 1)
+        self.soma = 0.0
+        self.n = 0
+
+    def observar(self, valor):
+        if self._registro.ativo:
+            self.baldes[bisect.bisect_left(self.limites, valor)] += 1
+            self.soma += valor
+            self.n += 1
+
+    def exportar(self):
+        return {
+            'limites': list(self.limites),
+            'baldes': list(self.baldes),
+            'soma': self.soma,
+            'n': self.n,
+        }
+
+
+class Registro:
+    def __init__(self):
+        """
+        Registro de métricas das camadas. Cada métrica é identificada por um
+        nome hierárquico separado por pontos, por exemplo
+        'ip.datagramas_encaminhados' ou 'enlace.192.168.200.1.quadros_recebidos'.
+        """
+        self.ativo = True
+        self._metricas = {}
+        self._externas = {}   # prefixo -> snapshot de outro processo
+
+    def _obter(self, nome, classe, *args):
+        metrica = self._metricas.get(nome)
+        if metrica is None:
+            metrica = classe(self, *args)
+            self._metricas[nome] = metrica
+        return metrica
+
+    def contador(self, nome):
+        return self._obter(nome, Contador)
+
+    def medidor(self, nome):
+        return self._obter(nome, Medidor)
+
+    def histograma(self, nome, limites=LIMITES_TEMPO):
+        return self._obter(nome, Histograma, limites)
+
+    def remover(self, prefixo):
+        """
+        Remove as métricas cujo nome começa com prefixo (por exemplo, as de
+        uma conexão encerrada).
+        """
+        for nome in [nome for nome in self._metricas if nome.startswith(prefixo)]:
+            del self._metricas[nome]
+
+    def incorporar(self, prefixo, valores):
+        """
+        Passa a incluir no snapshot as métricas valores (um snapshot obtido
+        em outro processo), com os nomes precedidos de prefixo. Uma nova
+        chamada com o mesmo prefixo substitui os valores anteriores. Pode ser
+        chamado de outra thread.
+        """
+        self._externas[prefixo] = valores
+
+    def ativar(self):
+        self.ativo = True
+
+    def desativar(self):
+        """
+        Desliga a instrumentação: as métricas deixam de ser atualizadas, e o
+        custo em cada ponto instrumentado passa a ser um único teste.
+        """
+        self.ativo = False
+
+    def snapshot(self):
+        """
+        Retorna um dicionário {nome: valor} com o estado atual das métricas.
+        """
+        resultado = {nome: metrica.exportar()
+                     for nome, metrica in self._metricas.items()}
+        for prefixo, valores in list(self._externas.items()):
+            for nome, valor in valores.items():
+                resultado[prefixo + nome] = valor
+        return dict(sorted(resultado.items()))
+
+    def para_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def salvar_json(self, caminho):
+        with open(caminho, 'w') as f:
+            f.write(self.para_json())
+
+    def servir(self, host='127.0.0.1', porta=9100):
+        """
+        Serve o snapshot em JSON via HTTP no endereço fornecido, usando o
+        mesmo laço de eventos das camadas. Deve ser chamado antes de
+        run_forever().
+        """
+        return asyncio.ensure_future(
+            asyncio.start_server(self.__atender, host, porta))
+
+    async def __atender(self, reader, writer):
+        try:
+            # Ignora a requisição: qualquer caminho devolve o snapshot
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            corpo = self.para_json().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: application/json\r\n' +
+                         b'Content-Length: %d\r\n\r\n' % len(corpo) + corpo)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+# Registro compartilhado por todas as camadas
+registro = Registro()
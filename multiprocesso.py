@@ -0,0 +1,269 @@
+import asyncio
+import multiprocessing
+import os
+import struct
+import threading
+import metricas
+from multiprocessing import shared_memory
+from ip import IP
+from slip import CamadaEnlace
+from tcputils import str2addr, addr2str
+
+
+class AnelCompartilhado:
+    """
+    Buffer circular em memória compartilhada, com um único produtor e um
+    único consumidor (cada um num processo). Os primeiros 16 bytes guardam os
+    índices de leitura e de escrita, que só crescem; cada registro é composto
+    por 2 bytes de tamanho, 4 bytes do next_hop e o datagrama.
+    """
+    _CABECALHO = 16
+
+    def __init__(self, capacidade):
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=self._CABECALHO + capacidade)
+        self._buf = self.shm.buf
+        self._capacidade = capacidade
+        struct.pack_into('!QQ', self._buf, 0, 0, 0)
+
+    def _copiar_para(self, pos, dados):
+        inicio = self._CABECALHO + pos % self._capacidade
+        parte = min(len(dados), self._CABECALHO + self._capacidade - inicio)
+        self._buf[inicio:inicio+parte] = dados[:parte]
+        self._buf[self._CABECALHO:self._CABECALHO+len(dados)-parte] = dados[parte:]
+
+    def _copiar_de(self, pos, n):
+        inicio = self._CABECALHO + pos % self._capacidade
+        parte = min(n, self._CABECALHO + self._capacidade - inicio)
+        return bytes(self._buf[inicio:inicio+parte]) + \
+            bytes(self._buf[self._CABECALHO:self._CABECALHO+n-parte])
+
+    def colocar(self, next_hop, datagrama):
+        """
+        Retorna False (e descarta o datagrama) se o anel estiver cheio.
+        """
+        leitura, escrita = struct.unpack_from('!QQ', self._buf, 0)
+        registro = struct.pack('!H4s', len(datagrama), str2addr(next_hop)) + datagrama
+        if escrita + len(registro) - leitura > self._capacidade:
+            return False
+        self._copiar_para(escrita, registro)
+        # Publica o registro só depois de copiá-lo por inteiro
+        struct.pack_into('!Q', self._buf, 8, escrita + len(registro))
+        return True
+
+    def retirar(self):
+        """
+        Retorna (next_hop, datagrama), ou None se o anel estiver vazio.
+        """
+        leitura, escrita = struct.unpack_from('!QQ', self._buf, 0)
+        if leitura == escrita:
+            return None
+        tamanho, next_hop = struct.unpack('!H4s', self._copiar_de(leitura, 6))
+        datagrama = self._copiar_de(leitura + 6, tamanho)
+        struct.pack_into('!Q', self._buf, 0, leitura + 6 + tamanho)
+        return addr2str(next_hop), datagrama
+
+    def liberar(self):
+        self._buf = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class _EnlaceTrabalhador:
+    ignore_checksum = False
+
+    def __init__(self, indice, enlace, donos, aneis, avisos):
+        """
+        Camada de enlace vista pelo IP de um processo trabalhador. Envia pelos
+        enlaces locais quando possível, e repassa os demais datagramas ao
+        trabalhador dono do enlace através do anel compartilhado.
+        """
+        self.indice = indice
+        self.enlace = enlace
+        self._donos = donos
+        self._aneis = aneis
+        self._avisos = avisos
+
+    def registrar_recebedor(self, callback):
+        self.enlace.registrar_recebedor(callback)
+
+    def enviar(self, datagrama, next_hop):
+        if next_hop in self.enlace.enlaces:
+            self.enlace.enviar(datagrama, next_hop)
+            return
+        dono = self._donos[next_hop]
+        if self._aneis[(self.indice, dono)].colocar(next_hop, datagrama):
+            try:
+                os.write(self._avisos[dono][1], b'\x00')
+            except BlockingIOError:
+                pass   # o dono já tem avisos pendentes
+
+
+class RoteadorMultiprocesso:
+    def __init__(self, grupos, meu_endereco, tabela, capacidade_anel=1<<20,
+                 cpus=None, intervalo_metricas=1.0, **opcoes_enlace):
+        """
+        Roteador cujo plano de encaminhamento é dividido entre vários
+        processos. O argumento grupos é uma lista com um dicionário
+        {ip_outra_ponta: fabrica_linha_serial} por processo trabalhador, onde
+        fabrica_linha_serial é uma função sem argumentos que cria a linha
+        serial (ela é chamada já dentro do processo trabalhador). Por exemplo:
+
+            roteador = RoteadorMultiprocesso([
+                {'192.168.200.1': PTY},
+                {'192.168.200.3': lambda: driver.obter_porta(0)},
+            ], '192.168.200.2', tabela)
+            roteador.iniciar()
+
+        Cada trabalhador tem seu próprio laço de eventos, sua CamadaEnlace
+        (construída com opcoes_enlace) e sua cópia da tabela de
+        encaminhamento. Os datagramas cujo próximo salto pertence a outro
+        trabalhador atravessam um anel em memória compartilhada.
+
+        Se cpus for fornecido, deve ser uma lista com um conjunto de CPUs por
+        grupo (por exemplo, [{0}, {1}]), e cada trabalhador fica restrito às
+        CPUs do seu grupo (os.sched_setaffinity, disponível só no Linux).
+
+        A cada intervalo_metricas segundos, os trabalhadores enviam suas
+        métricas ao processo de controle, onde aparecem no registro de
+        métricas com o prefixo 'trabalhador.<índice>.' (e, portanto, também
+        em metricas.registro.servir()).
+        """
+        self._grupos = grupos
+        self._meu_endereco = meu_endereco
+        self._tabela = tabela
+        self._capacidade_anel = capacidade_anel
+        self._cpus = cpus
+        self._intervalo_metricas = intervalo_metricas
+        self._opcoes_enlace = opcoes_enlace
+        self._donos = {ip_outra_ponta: i
+                       for i, grupo in enumerate(grupos)
+                       for ip_outra_ponta in grupo}
+        self._processos = []
+        self._controles = []
+        self._aneis = {}
+
+    def iniciar(self):
+        # fork: as fábricas de linhas seriais não precisam ser serializáveis
+        ctx = multiprocessing.get_context('fork')
+        n = len(self._grupos)
+        self._aneis = {(i, j): AnelCompartilhado(self._capacidade_anel)
+                       for i in range(n) for j in range(n) if i != j}
+        avisos = [os.pipe() for _ in range(n)]
+        for leitura, escrita in avisos:
+            os.set_blocking(leitura, False)
+            os.set_blocking(escrita, False)
+        for i in range(n):
+            controle, controle_trabalhador = ctx.Pipe()
+            processo = ctx.Process(target=self._trabalhador,
+                                   args=(i, controle, controle_trabalhador, avisos),
+                                   daemon=True)
+            processo.start()
+            # Só o trabalhador fica com a outra ponta, para que o fim dele
+            # seja percebido como EOF
+            controle_trabalhador.close()
+            self._processos.append(processo)
+            self._controles.append(controle)
+            threading.Thread(target=self._receber_metricas, args=(i, controle),
+                             daemon=True).start()
+        for leitura, escrita in avisos:
+            os.close(leitura)
+            os.close(escrita)
+
+    def _receber_metricas(self, indice, controle):
+        # Roda numa thread do processo de controle, até o trabalhador terminar
+        prefixo = 'trabalhador.%d.' % indice
+        while True:
+            try:
+                tipo, valores = controle.recv()
+            except (EOFError, OSError):
+                return
+            if tipo == 'metricas':
+                metricas.registro.incorporar(prefixo, valores)
+
+    def _trabalhador(self, indice, controle_pai, controle, avisos):
+        # Fecha as pontas do processo de controle herdadas no fork (a deste
+        # trabalhador e as dos anteriores), para que o fim do processo de
+        # controle seja percebido como EOF
+        for conexao in self._controles + [controle_pai]:
+            conexao.close()
+        if self._cpus is not None:
+            os.sched_setaffinity(0, self._cpus[indice])
+        # O registro herdado do processo de controle não interessa aqui
+        metricas.registro = metricas.Registro()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        linhas = {ip_outra_ponta: fabrica()
+                  for ip_outra_ponta, fabrica in self._grupos[indice].items()}
+        enlace = CamadaEnlace(linhas, **self._opcoes_enlace)
+        rede = IP(_EnlaceTrabalhador(indice, enlace, self._donos,
+                                     self._aneis, avisos))
+        rede.definir_endereco_host(self._meu_endereco)
+        rede.definir_tabela_encaminhamento(self._tabela)
+
+        entrada = [anel for (origem, destino), anel in self._aneis.items()
+                   if destino == indice]
+        aviso = avisos[indice][0]
+
+        def receber_aneis():
+            try:
+                while os.read(aviso, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            for anel in entrada:
+                item = anel.retirar()
+                while item is not None:
+                    next_hop, datagrama = item
+                    enlace.enviar(datagrama, next_hop)
+                    item = anel.retirar()
+
+        def receber_controle():
+            try:
+                metodo, args = controle.recv()
+            except EOFError:
+                metodo = None   # o processo de controle terminou
+            if metodo is None:
+                enviar_metricas(periodico=False)
+                loop.stop()
+            else:
+                getattr(rede, metodo)(*args)
+
+        def enviar_metricas(periodico=True):
+            try:
+                controle.send(('metricas', metricas.registro.snapshot()))
+            except OSError:
+                return   # o processo de controle terminou
+            if periodico:
+                loop.call_later(self._intervalo_metricas, enviar_metricas)
+
+        loop.add_reader(aviso, receber_aneis)
+        loop.add_reader(controle.fileno(), receber_controle)
+        enviar_metricas()
+        loop.run_forever()
+
+    def _difundir(self, metodo, *args):
+        for controle in self._controles:
+            controle.send((metodo, args))
+
+    def definir_tabela_encaminhamento(self, tabela):
+        """
+        Substitui a tabela de encaminhamento de todos os trabalhadores
+        (mesmo formato de IP.definir_tabela_encaminhamento).
+        """
+        self._tabela = tabela
+        self._difundir('definir_tabela_encaminhamento', tabela)
+
+    def definir_mtu(self, next_hop, mtu):
+        self._difundir('definir_mtu', next_hop, mtu)
+
+    def aguardar(self):
+        for processo in self._processos:
+            processo.join()
+
+    def parar(self):
+        self._difundir(None)
+        self.aguardar()
+        for anel in self._aneis.values():
+            anel.liberar()
+        self._aneis = {}
@@ -0,0 +1,187 @@
+import asyncio
+import concurrent.futures
+import struct
+import time
+from tcputils import str2addr, calc_checksum
+
+
+# Tipos de enlace do formato pcap (http://www.tcpdump.org/linktypes.html)
+LINKTYPE_RAW = 101      # datagramas IPv4/IPv6 sem cabeçalho de enlace
+LINKTYPE_USER0 = 147    # uso livre (por exemplo, bytes crus da linha serial)
+
+_PCAP_MAGIC = 0xa1b2c3d4
+_TAM_CABECALHO_GLOBAL = 24
+
+
+def cabecalho_global(linktype, snaplen):
+    return struct.pack('<IHHiIII', _PCAP_MAGIC, 2, 4, 0, 0, snaplen, linktype)
+
+
+def _datagrama_sintetico(src_addr, dst_addr, segmento):
+    # Cabeçalho IPv4 mínimo para que segmentos TCP possam ser gravados como
+    # LINKTYPE_RAW (a camada de rede não os entrega com cabeçalho)
+    hdr = struct.pack('!BBHHHBBH4s4s', (4 << 4) | 5, 0, 20 + len(segmento),
+                      0, 0, 64, 6, 0, str2addr(src_addr), str2addr(dst_addr))
+    hdr = hdr[:10] + struct.pack('!H', calc_checksum(hdr)) + hdr[12:]
+    return hdr + segmento
+
+
+class Captura:
+    def __init__(self, camada, caminho, linktype=LINKTYPE_RAW, snaplen=65535,
+                 anel_mb=None, arquivos_anel=4, limite_buffer=64*1024,
+                 intervalo=1.0, camada_rede=False):
+        """
+        Insere um ponto de captura entre duas camadas. O argumento camada é
+        qualquer objeto que implemente os métodos registrar_recebedor e enviar
+        (PTY, Enlace, CamadaEnlace...). A Captura implementa esses mesmos
+        métodos, então pode ser entregue à camada de cima no lugar de camada:
+
+            enlace = CamadaEnlace({outra_ponta: linha_serial})
+            rede = IP(Captura(enlace, 'rede.pcap'))
+
+        O primeiro argumento de cada chamada (o pacote) é gravado em caminho no
+        formato pcap, nos dois sentidos. Os pacotes maiores que snaplen são
+        truncados.
+
+        Para capturar entre o IP e o TCP, passe camada_rede=True:
+
+            servidor = Servidor(Captura(rede, 'tcp.pcap', camada_rede=True), 7000)
+
+        Nesse caso os segmentos TCP são gravados com um cabeçalho IPv4
+        sintético, para que o arquivo continue sendo LINKTYPE_RAW.
+
+        A gravação em disco é feita numa thread separada, em lotes de até
+        limite_buffer bytes ou a cada intervalo segundos, para não bloquear o
+        laço de eventos.
+
+        Se anel_mb for fornecido, a captura passa a funcionar como um buffer
+        circular em disco, como tcpdump -C/-W: os pacotes são gravados em
+        rodízio nos arquivos caminho.0, ..., caminho.N-1 (N = arquivos_anel),
+        cada um com até anel_mb/N megabytes, de forma que apenas os últimos
+        anel_mb megabytes sejam mantidos.
+        """
+        self.camada = camada
+        self.caminho = caminho
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.callback = None
+        self._camada_rede = camada_rede
+        self._fechada = False
+        self.camada.registrar_recebedor(self.__raw_recv)
+
+        self._limite_buffer = limite_buffer
+        self._intervalo = intervalo
+        # Uma única thread de escrita garante que os lotes cheguem em ordem
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pendentes = []
+        self._tam_pendentes = 0
+        self._timer = None
+
+        if anel_mb is not None:
+            self._limite_arquivo = int(anel_mb * 1024 * 1024 / arquivos_anel)
+            self._num_arquivos = arquivos_anel
+        else:
+            self._limite_arquivo = None
+        self._indice = 0
+        self._abrir_arquivo()
+
+    def __getattr__(self, nome):
+        # Repassa os demais atributos (por exemplo, ignore_checksum)
+        if nome == 'camada':
+            raise AttributeError(nome)
+        return getattr(self.camada, nome)
+
+    def registrar_recebedor(self, callback):
+        """
+        Registra uma função para ser chamada quando dados vierem da camada de baixo
+        """
+        self.callback = callback
+
+    def enviar(self, dados, *args):
+        """
+        Captura dados e os repassa à camada de baixo, junto com os demais
+        argumentos (por exemplo, o next_hop).
+        """
+        if self._camada_rede:
+            # enviar(segmento, dest_addr)
+            src = self.camada.meu_endereco or '0.0.0.0'
+            self._registrar(_datagrama_sintetico(src, args[0], dados))
+        else:
+            self._registrar(dados)
+        self.camada.enviar(dados, *args)
+
+    def __raw_recv(self, *args):
+        if len(args) == 3:
+            # A camada de rede entrega (src_addr, dst_addr, segmento)
+            self._registrar(_datagrama_sintetico(*args))
+        else:
+            self._registrar(args[0])
+        if self.callback:
+            self.callback(*args)
+
+    def _caminho_atual(self):
+        if self._limite_arquivo is None:
+            return self.caminho
+        return '%s.%d' % (self.caminho, self._indice)
+
+    def _abrir_arquivo(self):
+        self._executor.submit(self.__escrever, self._caminho_atual(), 'wb',
+                              [cabecalho_global(self.linktype, self.snaplen)])
+        self._tam_arquivo = _TAM_CABECALHO_GLOBAL
+
+    def _registrar(self, dados):
+        if self._fechada:
+            return
+        agora = time.time()
+        seg = int(agora)
+        incl = min(len(dados), self.snaplen)
+        registro = struct.pack('<IIII', seg, int((agora - seg) * 1e6),
+                               incl, len(dados)) + bytes(dados[:incl])
+
+        if self._limite_arquivo is not None and \
+                self._tam_arquivo + self._tam_pendentes + len(registro) > self._limite_arquivo and \
+                self._tam_arquivo + self._tam_pendentes > _TAM_CABECALHO_GLOBAL:
+            # O arquivo atual encheu: passa para o próximo do rodízio
+            self.descarregar()
+            self._indice = (self._indice + 1) % self._num_arquivos
+            self._abrir_arquivo()
+
+        self._pendentes.append(registro)
+        self._tam_pendentes += len(registro)
+        if self._tam_pendentes >= self._limite_buffer:
+            self.descarregar()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self._intervalo, self.descarregar)
+
+    def descarregar(self):
+        """
+        Envia para a thread de escrita os pacotes acumulados.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._fechada or not self._pendentes:
+            return None
+        registros = self._pendentes
+        self._tam_arquivo += self._tam_pendentes
+        self._pendentes = []
+        self._tam_pendentes = 0
+        return self._executor.submit(self.__escrever, self._caminho_atual(),
+                                     'ab', registros)
+
+    def fechar(self):
+        """
+        Grava o que estiver pendente e espera a thread de escrita terminar.
+        Depois disso, os pacotes continuam sendo repassados entre as camadas,
+        mas deixam de ser capturados.
+        """
+        if self._fechada:
+            return
+        self.descarregar()
+        self._fechada = True
+        self._executor.shutdown(wait=True)
+
+    def __escrever(self, caminho, modo, registros):
+        with open(caminho, modo) as f:
+            f.write(b''.join(registros))
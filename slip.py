@@ -1,7 +1,13 @@
+import cslip
+import metricas
+from fila import FilaSaida
+
+
 class CamadaEnlace:
     ignore_checksum = False
 
-    def __init__(self, linhas_seriais):
+    def __init__(self, linhas_seriais, comprimir_cabecalhos=False, escalonar=False,
+                 **opcoes_fila):
         """
         Inicia uma camada de enlace com um ou mais enlaces, cada um conectado
         a uma linha serial distinta. O argumento linhas_seriais é um dicionário
@@ -10,14 +16,28 @@ class CamadaEnlace:
         uma string no formato 'x.y.z.w'. A linha_serial é um objeto da classe
         PTY (vide camadafisica.py) ou de outra classe que implemente os métodos
         registrar_recebedor e enviar.
+
+        Se comprimir_cabecalhos for verdadeiro, os enlaces usam compressão de
+        cabeçalhos TCP/IP de Van Jacobson (CSLIP, RFC 1144). A outra ponta
+        precisa estar configurada da mesma forma (por exemplo, slattach -p cslip).
+        Segmentos com a opção Timestamps do TCP não são comprimidos, já que o
+        valor dela muda a cada segmento; para aproveitar a compressão, crie o
+        servidor com Servidor(rede, porta, timestamps=False).
+
+        Se escalonar for verdadeiro, cada enlace ganha uma fila de saída com
+        escalonamento justo entre fluxos (vide fila.FilaSaida, que recebe as
+        opcoes_fila, por exemplo taxa=115200 ou codel=True).
         """
         self.enlaces = {}
+        self.filas = {}
         self.callback = None
         # Constrói um Enlace para cada linha serial
         for ip_outra_ponta, linha_serial in linhas_seriais.items():
-            enlace = Enlace(linha_serial)
+            enlace = Enlace(linha_serial, ip_outra_ponta, comprimir_cabecalhos)
             self.enlaces[ip_outra_ponta] = enlace
             enlace.registrar_recebedor(self._callback)
+            if escalonar:
+                self.filas[ip_outra_ponta] = FilaSaida(enlace, ip_outra_ponta, **opcoes_fila)
 
     def registrar_recebedor(self, callback):
         """
@@ -32,7 +52,11 @@ class CamadaEnlace:
         responsabilizará por encontrar em qual enlace se encontra o next_hop.
         """
         # Encontra o Enlace capaz de alcançar next_hop e envia por ele
-        self.enlaces[next_hop].enviar(datagrama)
+        fila = self.filas.get(next_hop)
+        if fila is not None:
+            fila.enfileirar(datagrama)
+        else:
+            self.enlaces[next_hop].enviar(datagrama)
 
     def _callback(self, datagrama):
         if self.callback:
@@ -40,17 +64,41 @@ class CamadaEnlace:
 
 
 class Enlace:
-    def __init__(self, linha_serial):
+    def __init__(self, linha_serial, nome=None, comprimir_cabecalhos=False):
         self.linha_serial = linha_serial
         self._recv_buffer = bytearray()  
         self._escape = False              
         self._bad = False                
         self.linha_serial.registrar_recebedor(self.__raw_recv)
 
+        # Estado da compressão de cabeçalhos, um para cada sentido do enlace
+        if comprimir_cabecalhos:
+            self._compressor = cslip.Compressor()
+            self._descompressor = cslip.Descompressor()
+        else:
+            self._compressor = None
+            self._descompressor = None
+
+        # Métricas do enlace, identificadas pelo IP da outra ponta
+        prefixo = 'enlace.%s.' % (nome if nome is not None else id(self))
+        reg = metricas.registro
+        self._m_quadros_enviados = reg.contador(prefixo + 'quadros_enviados')
+        self._m_bytes_enviados = reg.contador(prefixo + 'bytes_enviados')
+        self._m_quadros_recebidos = reg.contador(prefixo + 'quadros_recebidos')
+        self._m_bytes_recebidos = reg.contador(prefixo + 'bytes_recebidos')
+        self._m_quadros_malformados = reg.contador(prefixo + 'quadros_malformados')
+        self._m_erros_callback = reg.contador(prefixo + 'erros_callback')
+        self._m_cabecalhos_comprimidos = reg.contador(prefixo + 'cabecalhos_comprimidos')
+        self._m_quadros_descartados = reg.contador(prefixo + 'quadros_descartados')
+
     def registrar_recebedor(self, callback):
         self.callback = callback
 
     def enviar(self, datagrama):
+        if self._compressor:
+            datagrama = self._compressor.comprimir(datagrama)
+            if datagrama[0] & cslip.TYPE_COMPRESSED_TCP:
+                self._m_cabecalhos_comprimidos.incrementar()
         meio = bytearray()
         for b in datagrama:
             if b == 0xC0:
@@ -61,6 +109,11 @@ class Enlace:
                 meio.append(b)
         quadro = b'\xC0' + bytes(meio) + b'\xC0'
         self.linha_serial.enviar(quadro)
+        self._m_quadros_enviados.incrementar()
+        self._m_bytes_enviados.incrementar(len(quadro))
+        # Tamanho real na linha (após compressão e escapes), usado pela
+        # FilaSaida para ritmar a transmissão
+        return len(quadro)
 
     def __raw_recv(self, dados):
         import traceback
@@ -70,12 +123,19 @@ class Enlace:
                 # fim de quadro (ou possível início de quadro vazio)
                 if not self._bad and len(self._recv_buffer) > 0:
                     datagrama = bytes(self._recv_buffer)
+                    self._m_quadros_recebidos.incrementar()
+                    self._m_bytes_recebidos.incrementar(len(datagrama))
                     try:
-                        if self.callback:
+                        if self._descompressor:
+                            datagrama = self._descompressor.descomprimir(datagrama)
+                        if datagrama is None:
+                            self._m_quadros_descartados.incrementar()
+                        elif self.callback:
                             self.callback(datagrama)
                     except Exception:
                         # mostra exceção, mas garante limpeza do buffer para não
                         # reapresentar restos do datagrama
+                        self._m_erros_callback.incrementar()
                         traceback.print_exc()
                     finally:
                         # sempre limpar estado do quadro atual
@@ -84,6 +144,12 @@ class Enlace:
                         self._bad = False
                 else:
                     # se quadro vazio ou mal formado: apenas resetamos o estado
+                    if self._bad:
+                        self._m_quadros_malformados.incrementar()
+                        if self._descompressor:
+                            # perdemos um quadro: o estado da descompressão
+                            # precisa ser ressincronizado
+                            self._descompressor.erro()
                     self._recv_buffer = bytearray()
                     self._escape = False
                     self._bad = False
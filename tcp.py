@@ -1,16 +1,57 @@
 import asyncio
 import random
 import time
+import struct
+import metricas
 from tcputils import *
 
+TCPOPT_TIMESTAMP = 8
+MAX_RETRANSMISSOES = 8   # retransmissões seguidas antes de abortar a conexão
+RTO_MAXIMO = 60.0        # limite do backoff exponencial (RFC 6298)
+
+
+def _relogio_ts():
+    # Relógio dos timestamps: milissegundos de um relógio monotônico (32 bits)
+    return int(time.monotonic() * 1000) & 0xffffffff
+
+
+def _ler_timestamp(opcoes):
+    """
+    Procura a opção Timestamps (RFC 7323) e retorna (TSval, TSecr), ou None.
+    """
+    i = 0
+    while i < len(opcoes):
+        tipo = opcoes[i]
+        if tipo == 0:
+            break
+        if tipo == 1:
+            i += 1
+            continue
+        if i + 1 >= len(opcoes) or opcoes[i+1] < 2:
+            break
+        if tipo == TCPOPT_TIMESTAMP and opcoes[i+1] == 10 and i + 10 <= len(opcoes):
+            return struct.unpack('!II', opcoes[i+2:i+10])
+        i += opcoes[i+1]
+    return None
+
 class Servidor:
-    def __init__(self, rede, porta):
+    def __init__(self, rede, porta, timestamps=True):
+        """
+        Servidor TCP na porta fornecida. Se timestamps for falso, a opção
+        Timestamps (RFC 7323) nunca é negociada, mesmo que o cliente a ofereça
+        (útil em enlaces CSLIP, que não comprimem segmentos com opções).
+        """
         self.rede = rede
         self.porta = porta
+        self.timestamps = timestamps
         self.conexoes = {}
         self.callback = None
         self.rede.registrar_recebedor(self._rdt_rcv)
 
+        reg = metricas.registro
+        self._m_checksum_incorreto = reg.contador('tcp.%d.checksum_incorreto' % porta)
+        self._m_conexao_desconhecida = reg.contador('tcp.%d.conexao_desconhecida' % porta)
+
     def registrar_monitor_de_conexoes_aceitas(self, callback):
         self.callback = callback
 
@@ -21,25 +62,25 @@ class Servidor:
         if dst_port != self.porta:
             return
         if not self.rede.ignore_checksum and calc_checksum(segment, src_addr, dst_addr) != 0:
-            print('descartando segmento com checksum incorreto')
+            self._m_checksum_incorreto.incrementar()
             return
 
         payload = segment[4*(flags>>12):]
+        opcoes = segment[20:4*(flags>>12)]
         id_conexao = (src_addr, src_port, dst_addr, dst_port)
 
         if (flags & FLAGS_SYN) == FLAGS_SYN:
-            conexao = Conexao(self, id_conexao, seq_no)
+            conexao = Conexao(self, id_conexao, seq_no, opcoes)
             self.conexoes[id_conexao] = conexao
             if self.callback:
                 self.callback(conexao)
         elif id_conexao in self.conexoes:
-            self.conexoes[id_conexao]._rdt_rcv(seq_no, ack_no, flags, payload)
+            self.conexoes[id_conexao]._rdt_rcv(seq_no, ack_no, flags, payload, opcoes)
         else:
-            print('%s:%d -> %s:%d (pacote associado a conexão desconhecida)' %
-                  (src_addr, src_port, dst_addr, dst_port))
+            self._m_conexao_desconhecida.incrementar()
 
 class Conexao:
-    def __init__(self, servidor, id_conexao, seq_no_cliente):
+    def __init__(self, servidor, id_conexao, seq_no_cliente, opcoes=b''):
         self.servidor = servidor
         self.id_conexao = id_conexao
         self.callback = None
@@ -56,9 +97,9 @@ class Conexao:
         self.seq_no_cliente_inicial = seq_no_cliente
 
         # Controle de envio: fila de segmentos a enviar e flag de segmento pendente
-        self._fila_envio = []  # lista de bytes (payloads)
+        self._fila_envio = bytearray()  # dados ainda não enviados
         self._enviando = False # True se há segmento aguardando ACK
-        self._ultimo_segmento_enviado = None # (payload, tamanho, segmento_completo)
+        self._ultimo_segmento_enviado = None # (payload, tamanho, seq_no original)
 
         # Para cálculo do RTT adaptativo
         self._estimated_rtt = None
@@ -68,6 +109,28 @@ class Conexao:
         self._timeout_interval = 1.0  # Valor inicial conservador
         self._tempo_envio = None      # Momento do último envio (para cálculo do SampleRTT)
         self._segmento_pendente_medicao = False  # Se o segmento pendente é elegível para medição
+        self._retransmissoes = 0      # Retransmissões seguidas sem ACK (para o backoff)
+
+        # Timestamps (RFC 7323): só são usados se o cliente os oferecer no SYN
+        # e o servidor não os tiver desligado.
+        # Com eles, todo ACK que confirma dados novos produz uma amostra de
+        # RTT, mesmo após retransmissões.
+        ts = _ler_timestamp(opcoes)
+        self._usar_timestamps = self.servidor.timestamps and ts is not None
+        self._ts_recent = ts[0] if ts else 0
+
+        # Métricas da conexão, identificadas pelo endereço e porta do cliente
+        prefixo = 'tcp.%d.%s:%d.' % (id_conexao[3], id_conexao[0], id_conexao[1])
+        self._prefixo_metricas = prefixo
+        reg = metricas.registro
+        # Uma reconexão a partir do mesmo ip:porta começa com métricas novas
+        reg.remover(prefixo)
+        self._m_segmentos_enviados = reg.contador(prefixo + 'segmentos_enviados')
+        self._m_segmentos_recebidos = reg.contador(prefixo + 'segmentos_recebidos')
+        self._m_retransmissoes = reg.contador(prefixo + 'retransmissoes')
+        self._m_rtt = reg.histograma(prefixo + 'rtt')
+        self._m_rto = reg.histograma(prefixo + 'rto')
+        self._m_bytes_em_transito = reg.medidor(prefixo + 'bytes_em_transito')
 
         # Envia SYN+ACK para completar o handshake
         self._enviar(FLAGS_SYN | FLAGS_ACK)
@@ -89,14 +152,40 @@ class Conexao:
     def _retransmitir(self):
         # Retransmite o último segmento enviado
         if self._enviando and self._ultimo_segmento_enviado:
+            self._retransmissoes += 1
+            if self._retransmissoes > MAX_RETRANSMISSOES:
+                # A outra ponta parou de responder
+                self._abortar()
+                return
             src_addr, src_port, dst_addr, dst_port = self.id_conexao
-            segmento = self._ultimo_segmento_enviado[2]
+            # Remonta o segmento para que ele leve um timestamp atual, mas com o
+            # número de sequência original (fechar() pode ter avançado seq_no)
+            payload, _, seq_no = self._ultimo_segmento_enviado
+            segmento = self._montar_segmento(FLAGS_ACK, payload, seq_no)
             self.servidor.rede.enviar(segmento, src_addr)
-            # Marca que não devemos medir RTT para retransmissões
+            self._m_segmentos_enviados.incrementar()
+            self._m_retransmissoes.incrementar()
+            # Marca que não devemos medir RTT para retransmissões (algoritmo de Karn)
             self._segmento_pendente_medicao = False
+            # Backoff exponencial: dobra o timeout até a próxima amostra de RTT
+            self._timeout_interval = min(2 * self._timeout_interval, RTO_MAXIMO)
+            self._m_rto.observar(self._timeout_interval)
             # Reagenda o timeout
             self._start_timeout()
 
+    def _abortar(self):
+        self._cancel_timeout()
+        self._enviando = False
+        self._ultimo_segmento_enviado = None
+        self._fila_envio = bytearray()
+        self._m_bytes_em_transito.definir(0)
+        self._enviar(FLAGS_RST | FLAGS_ACK)
+        self.estado = "ABORTADA"
+        self.servidor.conexoes.pop(self.id_conexao, None)
+        metricas.registro.remover(self._prefixo_metricas)
+        if self.callback:
+            self.callback(self, b"")
+
     def _atualizar_rtt(self, sample_rtt):
         """Atualiza EstimatedRTT e DevRTT conforme RFC 2988"""
         if self._estimated_rtt is None:
@@ -116,19 +205,47 @@ class Conexao:
         # Limites mínimos e máximos razoáveis para evitar timeout muito pequeno ou muito grande
         self._timeout_interval = max(0.1, min(self._timeout_interval, 10.0))
 
-    def _enviar(self, flags, payload=b''):
+        self._m_rtt.observar(sample_rtt)
+        self._m_rto.observar(self._timeout_interval)
+
+    def _montar_segmento(self, flags, payload=b'', seq_no=None):
         src_addr, src_port, dst_addr, dst_port = self.id_conexao
-        segmento = make_header(dst_port, src_port, self.seq_no, self.ack_no, flags)
+        if seq_no is None:
+            seq_no = self.seq_no
+        segmento = make_header(dst_port, src_port, seq_no, self.ack_no, flags)
+        if self._usar_timestamps:
+            # NOP, NOP, Timestamps: o cabeçalho passa a ter 8 palavras
+            segmento = segmento[:12] + struct.pack('!H', (8 << 12) | flags) + \
+                segmento[14:] + struct.pack('!BBBBII', 1, 1, TCPOPT_TIMESTAMP, 10,
+                                            _relogio_ts(), self._ts_recent)
         segmento += payload
-        segmento = fix_checksum(segmento, src_addr, dst_addr)
+        return fix_checksum(segmento, src_addr, dst_addr)
+
+    def _enviar(self, flags, payload=b''):
+        src_addr, src_port, dst_addr, dst_port = self.id_conexao
+        segmento = self._montar_segmento(flags, payload)
         self.servidor.rede.enviar(segmento, src_addr)
+        self._m_segmentos_enviados.incrementar()
 
-    def _rdt_rcv(self, seq_no, ack_no, flags, payload):
+    def _rdt_rcv(self, seq_no, ack_no, flags, payload, opcoes=b''):
+        self._m_segmentos_recebidos.incrementar()
+        if self.estado == "ABORTADA":
+            return
+        ts = _ler_timestamp(opcoes) if self._usar_timestamps else None
+        if ts is not None:
+            tsval, tsecr = ts
+            # Guarda o TSval mais recente dos segmentos que começam dentro do
+            # que já confirmamos, para ecoá-lo (RFC 7323, seção 4.3)
+            mais_novo = ((tsval - self._ts_recent) & 0xffffffff) < 0x80000000
+            ate_ack = ((self.ack_no - seq_no) & 0xffffffff) < 0x80000000
+            if mais_novo and ate_ack:
+                self._ts_recent = tsval
         # Se recebeu FIN, notifica aplicação e ajusta estado
         if (flags & FLAGS_FIN) == FLAGS_FIN:
             if self.callback:
                 self.callback(self, b"")
             self.estado = "FECHADA"
+            metricas.registro.remover(self._prefixo_metricas)
             # Envia ACK de fechamento
             self.ack_no += 1
             self._enviar(FLAGS_ACK)
@@ -149,6 +266,7 @@ class Conexao:
                 if self.callback:
                     self.callback(self, b"")
                 self.estado = "FECHADA"
+                metricas.registro.remover(self._prefixo_metricas)
                 # Envia ACK de fechamento
                 self._enviar(FLAGS_ACK)
                 return
@@ -169,10 +287,17 @@ class Conexao:
 
                 # Controle de envio: libera próximo segmento se ACK confirma o último enviado
                 if self._enviando and ack_no > self.seq_no:
-                    # Calcula SampleRTT apenas para transmissões originais (não retransmissões)
-                    if self._segmento_pendente_medicao and self._tempo_envio is not None:
-                        sample_rtt = time.time() - self._tempo_envio
+                    if ts is not None and tsecr != 0:
+                        # O TSecr ecoa o instante em que enviamos o segmento que
+                        # provocou este ACK, então a amostra não é ambígua
+                        sample_rtt = ((_relogio_ts() - tsecr) & 0xffffffff) / 1000
+                        self._atualizar_rtt(sample_rtt)
+                    # Sem timestamps, calcula SampleRTT apenas para transmissões
+                    # originais (não retransmissões)
+                    elif self._segmento_pendente_medicao and self._tempo_envio is not None:
+                        sample_rtt = time.monotonic() - self._tempo_envio
                         self._atualizar_rtt(sample_rtt)
+                    self._retransmissoes = 0
                     
                     # Atualiza seq_no com base no ack_no recebido
                     bytes_confirmados = ack_no - self.seq_no
@@ -180,6 +305,7 @@ class Conexao:
                     
                     self._enviando = False
                     self._ultimo_segmento_enviado = None
+                    self._m_bytes_em_transito.definir(0)
                     self._tempo_envio = None
                     self._segmento_pendente_medicao = False
                     self._cancel_timeout()
@@ -190,39 +316,52 @@ class Conexao:
         self.callback = callback
 
     def enviar(self, dados):
-        # Não envia nada se não houver dados
-        if len(dados) == 0:
+        # Não envia nada se não houver dados ou se a conexão foi abortada
+        if len(dados) == 0 or self.estado == "ABORTADA":
             return
 
-        # Fragmenta e adiciona à fila de envio
-        for i in range(0, len(dados), MSS):
-            segmento_dados = dados[i:i+MSS]
-            self._fila_envio.append(segmento_dados)
+        # Adiciona à fila de envio. A divisão em segmentos é feita no momento
+        # do envio, para respeitar o MSS efetivo (que pode diminuir caso a
+        # camada de rede descubra um MTU de caminho menor).
+        self._fila_envio.extend(dados)
 
         # Se não há segmento pendente, envia o próximo
         self._tentar_enviar_proximo()
 
     def _tentar_enviar_proximo(self):
+        if self.estado == "ABORTADA":
+            return
         if not self._enviando and self._fila_envio:
-            segmento_dados = self._fila_envio.pop(0)
+            mss = self._mss()
+            segmento_dados = bytes(self._fila_envio[:mss])
+            del self._fila_envio[:mss]
             src_addr, src_port, dst_addr, dst_port = self.id_conexao
-            segmento = make_header(dst_port, src_port, self.seq_no, self.ack_no, FLAGS_ACK)
-            segmento += segmento_dados
-            segmento = fix_checksum(segmento, src_addr, dst_addr)
+            segmento = self._montar_segmento(FLAGS_ACK, segmento_dados)
             self.servidor.rede.enviar(segmento, src_addr)
+            self._m_segmentos_enviados.incrementar()
             
             self._enviando = True
-            self._ultimo_segmento_enviado = (segmento_dados, len(segmento_dados), segmento)
-            self._tempo_envio = time.time()  # Registra momento do envio para cálculo do RTT
+            self._ultimo_segmento_enviado = (segmento_dados, len(segmento_dados), self.seq_no)
+            self._m_bytes_em_transito.definir(len(segmento_dados))
+            self._tempo_envio = time.monotonic()  # Registra momento do envio para cálculo do RTT
             self._segmento_pendente_medicao = True  # Este segmento é elegível para medição de RTT
             
             self._start_timeout()
 
+    def _mss(self):
+        # Usa o MSS informado pela camada de rede, se ela souber calculá-lo
+        mss_para = getattr(self.servidor.rede, 'mss_para', None)
+        mss = MSS if mss_para is None else min(MSS, mss_para(self.id_conexao[0]))
+        # A opção Timestamps ocupa 12 bytes de cada segmento
+        return mss - 12 if self._usar_timestamps else mss
+
     def fechar(self):
+        if self.estado == "ABORTADA":
+            return
         src_addr, src_port, dst_addr, dst_port = self.id_conexao
         self.seq_no += 1
-        segmento = make_header(dst_port, src_port, self.seq_no, self.ack_no, FLAGS_FIN | FLAGS_ACK)
-        segmento = fix_checksum(segmento, src_addr, dst_addr)
+        segmento = self._montar_segmento(FLAGS_FIN | FLAGS_ACK)
         self.servidor.rede.enviar(segmento, src_addr)
+        self._m_segmentos_enviados.incrementar()
 
 #teste  teste teste